@@ -0,0 +1,125 @@
+"""
+Blocklist -- Terms which should suppress an entry from the displays
+
+@author: James McCracken
+"""
+
+import os
+from collections import deque
+
+import twominuteconfig
+
+DEFAULT_FILE = twominuteconfig.BLOCKLIST
+# Used if no blocklist file is found
+DEFAULT_TERMS = ('shit', 'fuck', 'bugger', 'cunt', 'piss',)
+
+
+class Blocklist(object):
+
+    """
+    Multi-pattern matcher for blocked terms, compiled once when the
+    blocklist is loaded.
+
+    The blocklist file has one rule per line:
+     - 'term' blocks any lemma containing the term;
+     - '=term' blocks a lemma only if it is the whole term;
+     - 'term*' blocks any lemma beginning with the term.
+    Blank lines and lines beginning with '#' are ignored. Matching
+    is case-insensitive.
+    """
+
+    def __init__(self, **kwargs):
+        self.in_file = kwargs.get('filepath') or DEFAULT_FILE
+        self.whole_words = set()
+        # Trie of prefix rules; a node containing None marks the end
+        #  of a rule
+        self.prefixes = {}
+        # Aho-Corasick automaton for substring rules: goto transitions,
+        #  failure links, and whether a match ends at each node
+        self.goto = [{}]
+        self.fail = [0]
+        self.terminal = [False]
+        self.load_values()
+
+    def load_values(self):
+        if os.path.isfile(self.in_file):
+            with open(self.in_file, 'r') as filehandle:
+                rules = [line.strip() for line in filehandle]
+        else:
+            rules = list(DEFAULT_TERMS)
+
+        for rule in rules:
+            rule = rule.lower()
+            if not rule or rule.startswith('#'):
+                pass
+            elif rule.startswith('='):
+                self.whole_words.add(rule[1:])
+            elif rule.endswith('*'):
+                self._add_prefix(rule[:-1])
+            else:
+                self._add_substring(rule)
+        self._compile()
+
+    def matches(self, text):
+        """
+        Return True if the text is blocked by any of the rules.
+        """
+        text = text.lower()
+        if text in self.whole_words:
+            return True
+
+        node = self.prefixes
+        for char in text:
+            if None in node:
+                return True
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            if None in node:
+                return True
+
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.terminal[state]:
+                return True
+        return False
+
+    def _add_prefix(self, prefix):
+        node = self.prefixes
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = True
+
+    def _add_substring(self, term):
+        state = 0
+        for char in term:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.terminal.append(False)
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.terminal[state] = True
+
+    def _compile(self):
+        """
+        Compute failure links (breadth-first), so that the automaton
+        can match all substring rules in a single pass over the text.
+        """
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                self.terminal[child] = (self.terminal[child] or
+                                        self.terminal[self.fail[child]])
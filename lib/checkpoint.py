@@ -0,0 +1,113 @@
+"""
+Checkpoint -- Periodically persist the partial state of a long-running
+scan, so that it can resume after a crash
+
+@author: James McCracken
+"""
+
+import os
+import pickle
+
+import twominuteconfig
+
+
+class Checkpoint(object):
+
+    """
+    Checkpoint for a named process, stored under CHECKPOINT_DIR.
+
+    The checkpoint holds the iterator position (number of items consumed
+    so far) plus an arbitrary picklable state. Saves are atomic: the
+    data is written to a temporary file which then replaces the previous
+    checkpoint, so a crash mid-save leaves the previous checkpoint intact.
+
+    The checkpoint also records a signature made from a key (e.g. the
+    output file) and the size and modification time of the source data
+    (see source_signature()). A checkpoint whose signature does not
+    match the current one is discarded rather than resumed; and if any
+    source is undefined or missing, no checkpoint is ever resumed, since
+    changes to it could not be detected.
+    """
+
+    def __init__(self, name, **kwargs):
+        self.directory = (kwargs.get('directory') or
+                          twominuteconfig.CHECKPOINT_DIR)
+        self.interval = (kwargs.get('interval') or
+                         twominuteconfig.CHECKPOINT_INTERVAL)
+        self.key = kwargs.get('key')
+        self.sources = kwargs.get('sources', ())
+        self.signature = (self.key, source_signature(*self.sources))
+        self.filepath = os.path.join(self.directory, name + '.pickle')
+
+    def load(self):
+        """
+        Return a (position, state) tuple from the last checkpoint, or
+        (0, None) if there is no checkpoint (or only a stale one).
+        """
+        if self.signature[1] is None:
+            print('WARNING: checkpoints disabled for %s, since some source '
+                  'data is undefined or missing: %s' % (
+                      self.filepath, ', '.join([str(p) for p in self.sources
+                                                if not _exists(p)])))
+            self.clear()
+            return 0, None
+        if not os.path.isfile(self.filepath):
+            return 0, None
+        with open(self.filepath, 'rb') as filehandle:
+            data = pickle.load(filehandle)
+        if len(data) != 3 or data[0] != self.signature:
+            print('Discarding stale checkpoint %s...' % self.filepath)
+            self.clear()
+            return 0, None
+        return data[1], data[2]
+
+    def due(self, position):
+        return position % self.interval == 0
+
+    def save(self, position, state):
+        if self.signature[1] is None:
+            # Could never be safely resumed, so don't bother
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        temp_file = self.filepath + '.tmp'
+        with open(temp_file, 'wb') as filehandle:
+            pickle.dump((self.signature, position, state), filehandle,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            filehandle.flush()
+            os.fsync(filehandle.fileno())
+        os.replace(temp_file, self.filepath)
+
+    def clear(self):
+        """
+        Remove the checkpoint (once the process has completed).
+        """
+        if os.path.isfile(self.filepath):
+            os.remove(self.filepath)
+
+
+def source_signature(*paths):
+    """
+    Return a signature of the given files/directories: the path, size
+    and modification time of each file (recursing into directories).
+    Returns None if any path is undefined (None) or does not exist.
+    """
+    signature = []
+    for path in paths:
+        if not _exists(path):
+            return None
+        elif os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    filepath = os.path.join(dirpath, filename)
+                    stat = os.stat(filepath)
+                    signature.append((filepath, stat.st_size, stat.st_mtime))
+        else:
+            stat = os.stat(path)
+            signature.append((path, stat.st_size, stat.st_mtime))
+    return tuple(signature)
+
+
+def _exists(path):
+    return path is not None and os.path.exists(path)
@@ -6,6 +6,8 @@ LanguageOverrides
 
 from lex.entryiterator import EntryIterator
 
+from lib.prefetch import PrefetchIterator
+
 BASE_TO_DIALECT = (('Spanish', 'South American Spanish', None),
                    ('Spanish', 'Central American Spanish', None),
                    ('Spanish', 'American Spanish', None),
@@ -31,20 +33,24 @@ class LanguageOverrides(object):
     def __init__(self):
         pass
 
-    def list_language_overrides(self):
+    def list_language_overrides(self, entry_ids=None):
         """
         Return a dictionary for entries where the etymonLanguage given in
         the entry should be replaced by a new value,
         e.g. 'Spanish' -> 'Mexican Spanish'.
 
         Return value is a dict where keys are entry IDs and values are
-        the replacement language.
+        the replacement language. If entry_ids is given, only those
+        entries are checked.
         """
         dialect_words = {}
         iterator = EntryIterator(dictType='oed',
                                  verbosity=None,
                                  fixLigatures=True)
-        for entry in iterator.iterate():
+        prefetcher = PrefetchIterator(iterator.iterate())
+        for entry in prefetcher.iterate():
+            if entry_ids is not None and entry.id not in entry_ids:
+                continue
             language = entry.characteristic_first('etymonLanguage')
             if language:
                 dialect = None
@@ -55,6 +61,7 @@ class LanguageOverrides(object):
                     dialect = _check_old_english(entry)
                 if dialect:
                     dialect_words[entry.id] = dialect
+        print(prefetcher.report())
         return dialect_words
 
 
@@ -0,0 +1,134 @@
+"""
+PrefetchIterator -- Run an iterator in a background thread, so that
+reading/parsing the next items overlaps with processing the current ones
+
+@author: James McCracken
+"""
+
+import time
+import threading
+from queue import Queue, Full, Empty
+
+import twominuteconfig
+
+_DONE = object()
+
+
+class PrefetchIterator(object):
+
+    """
+    Wrap an iterable so that its items are produced by a background
+    thread and handed over in batches through a bounded queue.
+
+    At most depth * batch_size items are held in the queue at once.
+    Stall counters record how often the consumer found the queue empty
+    (the stage is I/O-bound) or the producer found it full (the stage
+    is CPU-bound).
+    """
+
+    def __init__(self, iterable, **kwargs):
+        self.iterable = iterable
+        self.depth = kwargs.get('depth') or twominuteconfig.PREFETCH_DEPTH
+        self.batch_size = (kwargs.get('batch_size') or
+                           twominuteconfig.PREFETCH_BATCH_SIZE)
+        self.stats = {'items': 0,
+                      'batches': 0,
+                      'consumer_stalls': 0,
+                      'consumer_wait': 0.0,
+                      'producer_stalls': 0,
+                      'producer_wait': 0.0,
+                      'elapsed': 0.0}
+
+    def iterate(self):
+        queue = Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(queue, stop))
+        thread.daemon = True
+        start = time.time()
+        thread.start()
+        try:
+            while True:
+                batch = self._get(queue)
+                if batch is _DONE:
+                    break
+                elif isinstance(batch, BaseException):
+                    raise batch
+                self.stats['batches'] += 1
+                for item in batch:
+                    self.stats['items'] += 1
+                    yield item
+        finally:
+            # If the consumer stopped early, make sure the producer is
+            #  not left blocked on a full queue
+            stop.set()
+            while thread.is_alive():
+                try:
+                    queue.get(timeout=0.1)
+                except Empty:
+                    pass
+            thread.join()
+            self.stats['elapsed'] = time.time() - start
+
+    def report(self):
+        """
+        Return a one-line summary of throughput and queue stalls.
+        """
+        elapsed = self.stats['elapsed'] or 1e-9
+        if self.stats['consumer_wait'] > self.stats['producer_wait']:
+            verdict = 'I/O-bound'
+        else:
+            verdict = 'CPU-bound'
+        return ('%d items in %.1fs (%.0f/s); consumer waited %.1fs '
+                '(%d stalls), producer waited %.1fs (%d stalls): %s' % (
+                    self.stats['items'], self.stats['elapsed'],
+                    self.stats['items'] / elapsed,
+                    self.stats['consumer_wait'], self.stats['consumer_stalls'],
+                    self.stats['producer_wait'], self.stats['producer_stalls'],
+                    verdict))
+
+    def _produce(self, queue, stop):
+        try:
+            batch = []
+            for item in self.iterable:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    if not self._put(queue, batch, stop):
+                        return
+                    batch = []
+            if batch and not self._put(queue, batch, stop):
+                return
+            self._put(queue, _DONE, stop)
+        except Exception as error:
+            self._put(queue, error, stop)
+
+    def _put(self, queue, value, stop):
+        """
+        Put a value on the queue, blocking while it is full. Returns
+        False if the consumer has stopped.
+        """
+        try:
+            queue.put_nowait(value)
+            return True
+        except Full:
+            self.stats['producer_stalls'] += 1
+        start = time.time()
+        try:
+            while not stop.is_set():
+                try:
+                    queue.put(value, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+        finally:
+            self.stats['producer_wait'] += time.time() - start
+
+    def _get(self, queue):
+        try:
+            return queue.get_nowait()
+        except Empty:
+            self.stats['consumer_stalls'] += 1
+        start = time.time()
+        value = queue.get()
+        self.stats['consumer_wait'] += time.time() - start
+        return value
@@ -4,17 +4,95 @@ Pipeline -- runs processes for building data for the 'two-minute-OED' app.
 @author: James McCracken
 """
 
+import os
+import sys
+import time
+import argparse
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+
 import twominuteconfig
 
 
-def dispatch():
-    for function_name, status in twominuteconfig.PIPELINE:
-        if status:
-            print('=' * 30)
-            print('Running "%s"...' % function_name)
-            print('=' * 30)
+def dispatch(jobs=1):
+    """
+    Run the enabled pipeline stages, each in its own process with its
+    own log file (in LOG_DIR). A stage starts once all the earlier
+    stages which write its inputs (see twominuteconfig.STAGE_ARTIFACTS)
+    have finished; up to 'jobs' stages run at once. If any stage fails,
+    the stages still running are stopped and an error is raised.
+    """
+    stages = [name for name, status in twominuteconfig.PIPELINE if status]
+    dependencies = _stage_dependencies(stages)
+    if not os.path.isdir(twominuteconfig.LOG_DIR):
+        os.makedirs(twominuteconfig.LOG_DIR)
+
+    context = multiprocessing.get_context('fork')
+    pending = list(stages)
+    running = {}
+    finished = set()
+    while pending or running:
+        for function_name in list(pending):
+            if len(running) >= jobs:
+                break
+            if dependencies[function_name] <= finished:
+                pending.remove(function_name)
+                log_file = os.path.join(twominuteconfig.LOG_DIR,
+                                        function_name + '.log')
+                process = context.Process(target=_run_stage,
+                                          args=(function_name, log_file),
+                                          name=function_name)
+                process.start()
+                running[function_name] = (process, log_file, time.time())
+                print('Running "%s" (log: %s)...' % (function_name, log_file))
+
+        wait([process.sentinel for process, _, _ in running.values()])
+        for function_name, (process, log_file, start) in list(running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del running[function_name]
+            if process.exitcode != 0:
+                for other, _, _ in running.values():
+                    other.terminate()
+                    other.join()
+                raise RuntimeError('"%s" failed (exit code %s); see %s' % (
+                    function_name, process.exitcode, log_file))
+            finished.add(function_name)
+            print('Finished "%s" in %.0fs' % (function_name,
+                                              time.time() - start))
+
+
+def _stage_dependencies(stages):
+    """
+    Return a dict mapping each stage to the set of earlier stages
+    which write one of its inputs.
+    """
+    dependencies = {}
+    for i, function_name in enumerate(stages):
+        inputs = set(twominuteconfig.STAGE_ARTIFACTS[function_name][0])
+        dependencies[function_name] = set(
+            [upstream for upstream in stages[:i] if
+             inputs & set(twominuteconfig.STAGE_ARTIFACTS[upstream][1])])
+    return dependencies
+
+
+def _run_stage(function_name, log_file):
+    """
+    Run a single stage (in a child process), with stdout and stderr
+    redirected to the stage's log file.
+    """
+    with open(log_file, 'w', buffering=1) as logfile:
+        os.dup2(logfile.fileno(), 1)
+        os.dup2(logfile.fileno(), 2)
+        sys.stdout = sys.stderr = logfile
+        try:
             function = globals()[function_name]
             function()
+        except Exception:
+            traceback.print_exc()
+            sys.exit(1)
 
 
 def analyse_language_frequency():
@@ -25,7 +103,8 @@ def analyse_language_frequency():
 
 def list_entries():
     from processes.entrylister import EntryLister
-    entry_lister = EntryLister(out_file=twominuteconfig.SOURCE_DATA)
+    entry_lister = EntryLister(out_file=twominuteconfig.SOURCE_DATA,
+                               incremental=twominuteconfig.INCREMENTAL_LISTING,)
     entry_lister.store_values()
 
 
@@ -41,8 +120,45 @@ def prepare_json_files():
                     languages='languages.json',
                     running_totals='running_totals.json',
                     increase_rate='increase_rates.json',
+                    density='density.json',
+                    frames='frames.json',
                     examples_log=twominuteconfig.EXAMPLE_WORDS_LOG,)
+    data_prep.entry_cache.build_top_index(k=twominuteconfig.TOP_K)
+    data_prep.entry_cache.save_top_index(twominuteconfig.TOP_INDEX)
+
+
+def sweep_parameters():
+    from processes.parametersweep import ParameterSweep
+    sweep = ParameterSweep(out_dir=twominuteconfig.SWEEP_DIR,
+                           grid=twominuteconfig.SWEEP_GRID,)
+    sweep.load_data(in_file=twominuteconfig.SOURCE_DATA,
+                    include_english=True,
+                    include_germanic=True,)
+    sweep.run()
+
+
+def serve_queries():
+    from processes.queryservice import EntryIndex, QueryServer
+    index = EntryIndex(in_file=twominuteconfig.SOURCE_DATA,
+                       include_english=True,
+                       include_germanic=True,
+                       include_unspecified=True,
+                       cache_size=twominuteconfig.QUERY_CACHE_SIZE,)
+    index.load_data()
+    server = QueryServer(index, twominuteconfig.QUERY_SERVER_ADDRESS)
+    print('Serving queries on %s:%d...' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 if __name__ == '__main__':
-    dispatch()
+    parser = argparse.ArgumentParser(description='Run the pipeline stages '
+                                     'enabled in twominuteconfig.PIPELINE')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='maximum number of stages to run at once')
+    args = parser.parse_args()
+    dispatch(jobs=max(1, args.jobs))
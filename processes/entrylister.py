@@ -4,8 +4,12 @@ EntryLister
 @author: James McCracken
 """
 
+import os
 import math
 import random
+import hashlib
+import heapq
+import json
 import csv
 import itertools
 from collections import defaultdict
@@ -17,62 +21,302 @@ from lex.oed.resources.frequencyiterator import FrequencyIterator
 import twominuteconfig
 from lib.coordinates import Coordinates
 from lib.languageoverrides import LanguageOverrides
+from lib.blocklist import Blocklist
+from lib.prefetch import PrefetchIterator
+from lib.checkpoint import Checkpoint, source_signature
+
+# First field of the row in the fingerprints file which records the
+#  source hashes (see EntryLister)
+SOURCES_MARKER = '#sources'
 
 
 class EntryLister(object):
 
+    """
+    List entries (lemma, label, id, year, frequency, band, language)
+    to the source data CSV file.
+
+    Alongside the CSV file, a sidecar file of per-entry fingerprints is
+    written. Fingerprints use only what the frequency iterator itself
+    provides (lemma, label, frequency), so they can be
+    checked cheaply. The sidecar also records a hash of the language
+    coordinates file and a signature of the vital statistics and entry
+    text data, since these also decide each entry's row.
+
+    In incremental mode, if the coordinates and the other data are
+    unchanged, rows are carried over from the existing CSV file (with
+    updated frequencies, for entries whose fingerprint has changed);
+    only new entries are looked up in the vital statistics and checked
+    for language overrides, and rows for deleted entries are dropped.
+    Otherwise, all entries are listed again.
+    """
+
     def __init__(self, **kwargs):
         self.out_file = kwargs.get('out_file')
+        self.incremental = kwargs.get('incremental', False)
+        self.fingerprint_file = self.out_file + '.fingerprints'
 
     def store_values(self):
+        sources = _sources_hashes()
+        if self.incremental:
+            reason = self._full_listing_reason(sources)
+            if reason is None:
+                self._store_changed_values(sources)
+                return
+            print('Listing all entries: %s' % reason)
+        self._store_all_values(sources)
+
+    def _full_listing_reason(self, sources):
+        """
+        Return the reason why an incremental listing is not possible,
+        or None if it is.
+        """
+        if not (os.path.isfile(self.out_file) and
+                os.path.isfile(self.fingerprint_file)):
+            return 'no previous listing'
+        if sources[1] is None:
+            return ('vital statistics or entry text data is undefined '
+                    'or missing')
+        previous_sources = self._read_fingerprints()[0]
+        if previous_sources[0] != sources[0]:
+            return 'language coordinates have changed'
+        if previous_sources[1] != sources[1]:
+            return 'vital statistics or entry text data has changed'
+        return None
+
+    def _store_all_values(self, sources):
         print('Loading coordinates...')
         coords = Coordinates()
-        print('Checking language overrides...')
-        overrides = LanguageOverrides().list_language_overrides()
+
+        # Pick up from the last checkpoint, if there is one
+        checkpoint = self._checkpoint()
+        position, state = checkpoint.load()
+        if state is not None:
+            print('Resuming from checkpoint (entry %d)...' % position)
+            overrides = state['overrides']
+            entries = state['entries']
+            fingerprints = state['fingerprints']
+        else:
+            print('Checking language overrides...')
+            overrides = LanguageOverrides().list_language_overrides()
+            entries = []
+            fingerprints = {}
+            checkpoint.save(position, {'overrides': overrides,
+                                       'entries': entries,
+                                       'fingerprints': fingerprints})
+
         print('Loading OED vital statistics...')
         vitalstats = VitalStatisticsCache()
 
-        entries = []
         iterator = FrequencyIterator(message='Listing entries')
-        for entry in iterator.iterate():
-            if (entry.has_frequency_table() and
-                    not ' ' in entry.lemma and
-                    not '-' in entry.lemma):
-                language_breadcrumb = vitalstats.find(entry.id, field='language')
-                year = vitalstats.find(entry.id, field='first_date') or 0
-
-                languages = []
-                if language_breadcrumb is not None:
-                    languages = [l for l in language_breadcrumb.split('/')
-                                 if coords.is_listed(l)
-                                 or l == 'English']
-                else:
-                    languages = ['unspecified', ]
-                if entry.id in overrides:
-                    languages = [overrides[entry.id], ]
-
-                if languages:
-                    # pick the most granular level (e.g. 'Icelandic' in
-                    #  preference to 'Germanic')
-                    language = languages[-1]
-                    # Find frequency for this word
-                    freq_table = entry.frequency_table()
-                    frequency = freq_table.frequency(period='modern')
-                    band = freq_table.band(period='modern')
-                    row = (entry.lemma,
-                           entry.label,
-                           entry.id,
-                           year,
-                           frequency,
-                           band,
-                           language)
+        prefetcher = PrefetchIterator(
+            itertools.islice(iterator.iterate(), position, None))
+        for entry in prefetcher.iterate():
+            position += 1
+            frequency_details = _frequency_details(entry)
+            if frequency_details is not None:
+                fingerprints[str(entry.id)] = _fingerprint(frequency_details)
+                details = _entry_details(frequency_details, vitalstats)
+                row = _entry_row(details, coords, overrides)
+                if row is not None:
                     entries.append(row)
 
+            if checkpoint.due(position):
+                checkpoint.save(position, {'overrides': overrides,
+                                           'entries': entries,
+                                           'fingerprints': fingerprints})
+
+        print(prefetcher.report())
         entries = sorted(entries, key=lambda entry: entry[2])
 
         with (open(self.out_file, 'w')) as csvfile:
             writer = csv.writer(csvfile)
             writer.writerows(entries)
+        self._write_fingerprints(sources, fingerprints)
+        checkpoint.clear()
+
+    def _store_changed_values(self, sources):
+        print('Loading coordinates...')
+        coords = Coordinates()
+        print('Loading previous entry list...')
+        with (open(self.out_file, 'r')) as csvfile:
+            previous_rows = {row[2]: row for row in csv.reader(csvfile)}
+        previous_fingerprints = self._read_fingerprints()[1]
+
+        # Since the language coordinates, vital statistics and entry text
+        #  are unchanged, an entry which was listed before keeps its year
+        #  and language; only its frequency data needs updating. Only
+        #  entries which were not listed by the frequency iterator
+        #  before need to be looked up in full.
+        entries = []
+        new_entries = {}
+        fingerprints = {}
+        iterator = FrequencyIterator(message='Checking entries for changes')
+        prefetcher = PrefetchIterator(iterator.iterate())
+        for entry in prefetcher.iterate():
+            frequency_details = _frequency_details(entry)
+            if frequency_details is None:
+                continue
+            entry_id = str(entry.id)
+            fingerprint = _fingerprint(frequency_details)
+            fingerprints[entry_id] = fingerprint
+            if entry_id not in previous_fingerprints:
+                new_entries[entry.id] = frequency_details
+            elif entry_id in previous_rows:
+                row = previous_rows[entry_id]
+                if previous_fingerprints[entry_id] != fingerprint:
+                    lemma, label, _, frequency, band = frequency_details
+                    row = (lemma, label, row[2], row[3], frequency, band,
+                           row[6])
+                entries.append(row)
+        print(prefetcher.report())
+
+        print('Listing %d new entries...' % len(new_entries))
+        if new_entries:
+            print('Checking language overrides...')
+            overrides = LanguageOverrides().list_language_overrides(
+                entry_ids=set(new_entries.keys()))
+            print('Loading OED vital statistics...')
+            vitalstats = VitalStatisticsCache()
+            for frequency_details in new_entries.values():
+                details = _entry_details(frequency_details, vitalstats)
+                row = _entry_row(details, coords, overrides)
+                if row is not None:
+                    entries.append(row)
+
+        entries = sorted(entries, key=lambda entry: int(entry[2]))
+
+        with (open(self.out_file, 'w')) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerows(entries)
+        self._write_fingerprints(sources, fingerprints)
+        # Any checkpoint left by an interrupted full run is now obsolete
+        self._checkpoint().clear()
+
+    def _checkpoint(self):
+        """
+        Return the checkpoint for a full listing, tied to the output
+        file, the current OED data, and the language coordinates (which
+        decide which languages are listed).
+        """
+        sources = (twominuteconfig.OED_FREQUENCY_DATA,
+                   twominuteconfig.OED_VITALSTATS_DATA,
+                   twominuteconfig.OED_TEXT_DATA,
+                   twominuteconfig.LANGUAGE_COORDINATES)
+        return Checkpoint('list_entries',
+                          key=os.path.abspath(self.out_file),
+                          sources=sources)
+
+    def _read_fingerprints(self):
+        """
+        Return the source hashes and the fingerprints (a dict of entry
+        ID -> hash) recorded by the last run.
+        """
+        sources = (None, None)
+        fingerprints = {}
+        with (open(self.fingerprint_file, 'r')) as csvfile:
+            for row in csv.reader(csvfile):
+                if row[0] == SOURCES_MARKER:
+                    sources = (row[1] or None, row[2] or None)
+                else:
+                    fingerprints[row[0]] = row[1]
+        return sources, fingerprints
+
+    def _write_fingerprints(self, sources, fingerprints):
+        with (open(self.fingerprint_file, 'w')) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow([SOURCES_MARKER, sources[0] or '',
+                             sources[1] or ''])
+            writer.writerows(sorted(fingerprints.items()))
+
+
+def _frequency_details(entry):
+    """
+    Return a tuple of the details of an entry which are available
+    directly from the frequency iterator (lemma, label, id, frequency,
+    band), or None if the entry is not listed at all.
+    """
+    if (entry.has_frequency_table() and
+            not ' ' in entry.lemma and
+            not '-' in entry.lemma):
+        # Find frequency for this word
+        freq_table = entry.frequency_table()
+        frequency = freq_table.frequency(period='modern')
+        band = freq_table.band(period='modern')
+        return (entry.lemma, entry.label, entry.id, frequency, band)
+    else:
+        return None
+
+
+def _entry_details(frequency_details, vitalstats):
+    """
+    Return a tuple of the details needed to list an entry (lemma, label,
+    id, year, language breadcrumb, frequency, band).
+    """
+    lemma, label, entry_id, frequency, band = frequency_details
+    language_breadcrumb = vitalstats.find(entry_id, field='language')
+    year = vitalstats.find(entry_id, field='first_date') or 0
+    return (lemma, label, entry_id, year, language_breadcrumb,
+            frequency, band)
+
+
+def _entry_row(details, coords, overrides):
+    """
+    Return the CSV row for an entry, or None if no usable language
+    can be found for it.
+    """
+    (lemma, label, entry_id, year, language_breadcrumb,
+     frequency, band) = details
+    languages = []
+    if language_breadcrumb is not None:
+        languages = [l for l in language_breadcrumb.split('/')
+                     if coords.is_listed(l)
+                     or l == 'English']
+    else:
+        languages = ['unspecified', ]
+    if entry_id in overrides:
+        languages = [overrides[entry_id], ]
+
+    if languages:
+        # pick the most granular level (e.g. 'Icelandic' in
+        #  preference to 'Germanic')
+        language = languages[-1]
+        return (lemma,
+                label,
+                entry_id,
+                year,
+                frequency,
+                band,
+                language)
+    else:
+        return None
+
+
+def _fingerprint(frequency_details):
+    """
+    Return a hash of an entry's lemma, label, and frequency, used to
+    detect whether it has changed since the last run.
+    """
+    lemma, label, entry_id, frequency, band = frequency_details
+    text = '\t'.join([lemma, str(label), repr(frequency), str(band)])
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def _sources_hashes():
+    """
+    Return a hash of the language coordinates file, and a hash of the
+    signature of the vital statistics and entry text data (or None if
+    that data is undefined or missing).
+    """
+    with open(twominuteconfig.LANGUAGE_COORDINATES, 'rb') as filehandle:
+        coordinates = hashlib.md5(filehandle.read()).hexdigest()
+    signature = source_signature(twominuteconfig.OED_VITALSTATS_DATA,
+                                 twominuteconfig.OED_TEXT_DATA)
+    if signature is None:
+        data = None
+    else:
+        data = hashlib.md5(repr(signature).encode('utf-8')).hexdigest()
+    return coordinates, data
 
 
 class EntryCache(object):
@@ -84,9 +328,12 @@ class EntryCache(object):
         self.include_unspecified = kwargs.get('include_unspecified', False)
         self.entries = list()
         self.cumulations = dict()
+        self.top_k = None
+        self.top_index = dict()
 
     def load_data(self):
         self.entries = []
+        blocklist = Blocklist()
         with (open(self.in_file, 'r')) as csvfile:
             reader = csv.reader(csvfile)
             for row in reader:
@@ -103,6 +350,7 @@ class EntryCache(object):
                       entry.language in ('Germanic', 'West Germanic',)):
                     pass
                 else:
+                    entry.suppressed = blocklist.matches(entry.lemma)
                     self.entries.append(entry)
 
     def dither(self):
@@ -133,6 +381,100 @@ class EntryCache(object):
     def cumulative_total(self, year):
         return sum(self.cumulate(year).values())
 
+    def build_top_index(self, k=None):
+        """
+        Build an index of the k highest-frequency entries overall, for
+        each (dithered) year, each decade, and each language group, and
+        for each year and decade within each language group.
+
+        Built in a single pass, keeping a bounded heap for each key.
+        """
+        if not self.entries:
+            self.load_data()
+        self.top_k = k or twominuteconfig.TOP_K
+        heaps = defaultdict(list)
+        for i, entry in enumerate(self.entries):
+            item = (entry.frequency, -i, entry)
+            for key in _top_index_keys(entry):
+                heap = heaps[key]
+                if len(heap) < self.top_k:
+                    heapq.heappush(heap, item)
+                elif item[:2] > heap[0][:2]:
+                    heapq.heapreplace(heap, item)
+        self.top_index = {key: [item[2] for item in
+                                sorted(heap, key=lambda i: i[:2], reverse=True)]
+                          for key, heap in heaps.items()}
+
+    def top_entries(self, k=None, year=None, decade=None, group=None):
+        """
+        Return the k highest-frequency entries (highest first) for a
+        given year or decade and/or language group (or overall, if none
+        is given), from the top-k index.
+        """
+        if year is not None and decade is not None:
+            raise ValueError('Specify either a year or a decade, not both')
+        if not self.top_index:
+            self.build_top_index(k)
+        k = k or self.top_k
+        if k > self.top_k:
+            raise ValueError('Index only holds the top %d entries' % self.top_k)
+        if year is not None:
+            key = ('year', year, group)
+        elif decade is not None:
+            key = ('decade', (decade // 10) * 10, group)
+        else:
+            key = ('all', None, group)
+        return self.top_index.get(key, [])[:k]
+
+    def save_top_index(self, out_file):
+        """
+        Write the top-k index as compact JSON: each key
+        ('year:1650:latin', 'decade:1650:', 'all::latin', 'all::', etc.)
+        maps to the list of IDs of its entries, highest frequency first.
+        """
+        index = {':'.join([str(v) if v is not None else '' for v in key]):
+                 [e.id for e in entries]
+                 for key, entries in self.top_index.items()}
+        with open(out_file, 'w') as filehandle:
+            json.dump({'k': self.top_k, 'index': index}, filehandle,
+                      separators=(',', ':'))
+
+    def load_top_index(self, in_file):
+        """
+        Load a top-k index written by save_top_index(), mapping its
+        entry IDs back to the entries in this cache. (Note that year
+        and decade keys refer to the dithered years of the run which
+        built the index.)
+        """
+        if not self.entries:
+            self.load_data()
+        with open(in_file, 'r') as filehandle:
+            data = json.load(filehandle)
+        entries = {str(e.id): e for e in self.entries}
+        self.top_k = data['k']
+        self.top_index = {}
+        for key, ids in data['index'].items():
+            scope, value, group = key.split(':')
+            if scope in ('year', 'decade'):
+                value = int(value)
+            else:
+                value = None
+            self.top_index[(scope, value, group or None)] = [
+                entries[str(i)] for i in ids if str(i) in entries]
+
+
+def _top_index_keys(entry):
+    year = entry.dithered_year()
+    decade = (year // 10) * 10
+    group = entry.language_group()
+    keys = [('year', year, None), ('decade', decade, None),
+            ('all', None, None)]
+    if group is not None:
+        keys.extend([('year', year, group),
+                     ('decade', decade, group),
+                     ('all', None, group)])
+    return keys
+
 
 def _compute_dither_range(dithers, end_year):
     years = range(500, end_year + 1)
@@ -152,6 +494,9 @@ class Entry(object):
         self.year = int(self.year)
         self.band = int(self.band)
         self.frequency = float(self.frequency)
+        # Set to True if the lemma is blocked (e.g. vulgar words), so
+        #  that the entry is excluded from the word displays
+        self.suppressed = False
 
     def dithered_year(self):
         try:
@@ -224,4 +569,18 @@ class Entry(object):
         distance = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
         return distance
 
+    def centre_distance(self):
+        """
+        Return the distance between this point and the central point
+        (see twominuteconfig.CENTRAL_POINT). Cached, since this is
+        used repeatedly when winnowing.
+        """
+        try:
+            return self._centre_distance
+        except AttributeError:
+            self._centre_distance = self.distance(
+                twominuteconfig.CENTRAL_POINT[0],
+                twominuteconfig.CENTRAL_POINT[1])
+            return self._centre_distance
+
 
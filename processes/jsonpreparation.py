@@ -6,6 +6,7 @@ JsonPreparation -- Prepare JSON data files to be read by the D3 app
 
 import os
 import random
+import contextlib
 from collections import defaultdict
 import json
 import numpy
@@ -20,6 +21,12 @@ START_YEAR = twominuteconfig.START_YEAR
 END_YEAR = twominuteconfig.END_YEAR
 LANGUAGE_GROUPS = twominuteconfig.LANGUAGE_GROUPS
 CENTRAL_POINT = twominuteconfig.CENTRAL_POINT
+WINNOW_LIMIT = twominuteconfig.WINNOW_LIMIT
+RANDOM_EXAMPLES = twominuteconfig.RANDOM_EXAMPLES
+DENSITY_CELL_SIZE = twominuteconfig.DENSITY_CELL_SIZE
+FRAME_KEYFRAME_INTERVAL = twominuteconfig.FRAME_KEYFRAME_INTERVAL
+# Languages treated as English etymology, and so never shown
+ENGLISH_LANGUAGES = ('English', 'Germanic', 'West Germanic')
 
 
 class JsonPreparation(object):
@@ -41,32 +48,27 @@ class JsonPreparation(object):
         examples_log_file = kwargs.get('examples_log')
         files = {k: os.path.join(out_dir, v) for k, v in kwargs.items()}
         language_index = self._write_language_file(files['languages'])
-        self._write_running_totals_file(files['running_totals'])
+        running_totals = self._write_running_totals_file(
+            files['running_totals'])
         self._write_increase_rate_file(files['increase_rate'])
-
-        entries = defaultdict(list)
-        examples = {}
-        for year, entry_list in self.groups:
-            if START_YEAR <= year <= END_YEAR:
-                for entry in entry_list:
-                    entry.coordinates()
-                entry_list = _winnow(entry_list)
-                examples[year] = list(_choose_examples(entry_list, year))
-                for entry in entry_list:
-                    freq = float('%.1g' % entry.frequency)
-                    if freq >= 1:
-                        freq = int(freq)
-                    freq = max(freq, 0.0001)
-                    entries[year].append((
-                        entry.id,
-                        entry.lemma,
-                        entry.band,
-                        freq,
-                        language_index[entry.language],
-                    ))
-
-        _write_words_file(entries, files['words'])
-        _write_examples_file(examples, files['examples'], examples_log_file)
+        if 'density' in files:
+            self._write_density_file(files['density'])
+        if 'frames' in files:
+            self._write_frames_file(files['frames'], running_totals,
+                                    language_index)
+
+        with open(files['words'], 'w') as filehandle, \
+                ExamplesWriter(files['examples'],
+                               examples_log_file) as examples:
+            words = YearStream(filehandle)
+            for year, entry_list in self.groups:
+                if START_YEAR <= year <= END_YEAR:
+                    for entry in entry_list:
+                        entry.coordinates()
+                    entry_list = _winnow(entry_list)
+                    examples.add(year, _choose_examples(entry_list, year))
+                    _add_words(words, year, entry_list, language_index)
+            words.close()
 
     def _write_running_totals_file(self, out_file):
         running_totals = {499: {group: 0 for group in LANGUAGE_GROUPS}}
@@ -104,6 +106,51 @@ class JsonPreparation(object):
 
         with open(out_file, 'w') as filehandle:
             json.dump(minified, filehandle)
+        return minified
+
+    def _write_frames_file(self, out_file, running_totals, language_index):
+        """
+        Write a frame-oriented version of the running totals, plus the
+        year in which each language first appears.
+
+        A keyframe (full vectors of summed frequencies and counts, as in
+        running_totals.json) is stored every FRAME_KEYFRAME_INTERVAL
+        years from START_YEAR. Between keyframes, only years where the
+        totals change are stored, as differences from the preceding
+        keyframe; any other year has the same values as the latest
+        stored year before it. 'languages' lists the first (dithered)
+        year of each language, in the order of languages.json.
+        """
+        sums = running_totals['summedfrequencies']
+        counts = running_totals['counts']
+        keyframes = {}
+        deltas = {}
+        previous = None
+        for year in range(START_YEAR, END_YEAR + 1):
+            if (year - START_YEAR) % FRAME_KEYFRAME_INTERVAL == 0:
+                keyframe = year
+                keyframes[year] = [sums[year], counts[year]]
+            elif [sums[year], counts[year]] != previous:
+                deltas[year] = [
+                    [v - k for v, k in zip(sums[year], sums[keyframe])],
+                    [v - k for v, k in zip(counts[year], counts[keyframe])]]
+            previous = [sums[year], counts[year]]
+
+        first_years = [None] * len(language_index)
+        for year, entry_list in self.groups:
+            if START_YEAR <= year <= END_YEAR:
+                for entry in entry_list:
+                    i = language_index[entry.language]
+                    if first_years[i] is None:
+                        first_years[i] = year
+
+        frames = {'groups': LANGUAGE_GROUPS,
+                  'interval': FRAME_KEYFRAME_INTERVAL,
+                  'keyframes': keyframes,
+                  'deltas': deltas,
+                  'languages': first_years}
+        with open(out_file, 'w') as filehandle:
+            json.dump(frames, filehandle, separators=(',', ':'))
 
     def _write_increase_rate_file(self, out_file):
         rates = defaultdict(int)
@@ -128,6 +175,69 @@ class JsonPreparation(object):
         with open(out_file, 'w') as filehandle:
             json.dump(rates, filehandle)
 
+    def _write_density_file(self, out_file):
+        """
+        Bin entry coordinates into a lat/lon grid for each language
+        group, so that the D3 app can draw density without aggregating
+        points itself.
+
+        Cells are numbered (group * rows + row) * columns + column,
+        where row 0 starts at latitude -90 and column 0 at longitude
+        -180. 'base' gives the cumulative counts for all years before
+        ANIMATION_START; 'deltas' gives, for each later year, the
+        counts to be added to the running totals. Both are flat lists
+        of alternating cell numbers and counts, omitting empty cells.
+        """
+        rows = int(180 / DENSITY_CELL_SIZE)
+        columns = int(360 / DENSITY_CELL_SIZE)
+        num_cells = len(LANGUAGE_GROUPS) * rows * columns
+        group_index = {g: i for i, g in enumerate(LANGUAGE_GROUPS)}
+
+        # Every year before ANIMATION_START goes into 'base' (not just
+        #  those from START_YEAR), including dithered outliers, so that
+        #  the density agrees with the running totals
+        years, groups, coordinates = [], [], []
+        for year, entry_list in self.groups:
+            if year <= END_YEAR:
+                for entry in entry_list:
+                    if (entry.language_group() in group_index and
+                            entry.coordinates() is not None):
+                        years.append(year)
+                        groups.append(group_index[entry.language_group()])
+                        coordinates.append(entry.coordinates())
+        years = numpy.array(years, dtype=int)
+        coordinates = numpy.array(coordinates, dtype=float).reshape(-1, 2)
+
+        row = numpy.clip(((coordinates[:, 0] + 90) //
+                          DENSITY_CELL_SIZE).astype(int), 0, rows - 1)
+        column = numpy.clip(((coordinates[:, 1] + 180) //
+                             DENSITY_CELL_SIZE).astype(int), 0, columns - 1)
+        cells = ((numpy.array(groups, dtype=int) * rows + row) *
+                 columns + column)
+
+        # Cumulative counts for everything before the animation starts
+        early = years < ANIMATION_START
+        base = numpy.bincount(cells[early], minlength=num_cells)
+
+        # Per-year counts (i.e. the year-on-year increase in the
+        #  cumulative counts) for each year of the animation
+        keys = (years[~early] - ANIMATION_START) * num_cells + cells[~early]
+        keys, counts = numpy.unique(keys, return_counts=True)
+        deltas = defaultdict(list)
+        for key, count in zip(keys, counts):
+            year, cell = divmod(int(key), num_cells)
+            deltas[year + ANIMATION_START].extend([cell, int(count)])
+
+        density = {'cellsize': DENSITY_CELL_SIZE,
+                   'rows': rows,
+                   'columns': columns,
+                   'groups': LANGUAGE_GROUPS,
+                   'base': [int(v) for cell in numpy.flatnonzero(base)
+                            for v in (cell, base[cell])],
+                   'deltas': deltas}
+        with open(out_file, 'w') as filehandle:
+            json.dump(density, filehandle, separators=(',', ':'))
+
     def _write_language_file(self, out_file):
         coords = Coordinates()
         langs = defaultdict(lambda: {'count': 0, 'group': None})
@@ -159,7 +269,41 @@ class JsonPreparation(object):
         return language_index
 
 
-def _winnow(entries):
+def _word_row(entry, language_index):
+    """
+    Return the compact tuple used to represent an entry in words.json.
+    """
+    freq = float('%.1g' % entry.frequency)
+    if freq >= 1:
+        freq = int(freq)
+    freq = max(freq, 0.0001)
+    return (entry.id,
+            entry.lemma,
+            entry.band,
+            freq,
+            language_index[entry.language],)
+
+
+def _winnow(entries, limit=WINNOW_LIMIT):
+    # Remove words with English etymology
+    entries = [e for e in entries if e.language not in ENGLISH_LANGUAGES]
+
+    # Remove blocked (e.g. vulgar) words
+    entries = [e for e in entries if not e.suppressed]
+
+    # Sort by distance from UK (from Leicester, in fact)
+    entries.sort(key=lambda p: p.centre_distance())
+
+    entries = _thin_out(entries, limit)
+    entries.sort(key=lambda e: e.frequency, reverse=True)
+    return entries
+
+
+def _thin_out(items, limit):
+    """
+    Return a copy of the list of items (sorted by distance from UK)
+    winnowed down to the limit at the most.
+    """
     def weighted_choice_sub(weights):
         random_num = random.random() * sum(weights)
         for i, weight in enumerate(weights):
@@ -167,99 +311,154 @@ def _winnow(entries):
             if random_num < 0:
                 return i
 
-    # Remove words with English etymology
-    entries = [e for e in entries if e.language not in
-               ('English', 'Germanic', 'West Germanic')]
-
-    entries = _remove_vulgar(entries)
-
-    # Sort by distance from UK (from Leicester, in fact)
-    entries.sort(key=lambda p: p.distance(CENTRAL_POINT[0], CENTRAL_POINT[1]))
-
-    # Now winnow down to 50 entries at the most, using weighted random choice
-    #   so that points further from Leicester have less chance of being
-    #   winnowed out.
+    # Use weighted random choice so that points further from Leicester
+    #   have less chance of being winnowed out.
     # (Hopefully, this means that entries will tend to be winnowed
     #   from the indistinct morass of French and Germanic entries).
-    while len(entries) > 50:
-        weights = [len(entries) - i + 3 for i, e in enumerate(entries)]
+    items = list(items)
+    while len(items) > limit:
+        weights = [len(items) - i + 3 for i, e in enumerate(items)]
         index = weighted_choice_sub(weights)
-        entries.pop(index)
-    entries.sort(key=lambda e: e.frequency, reverse=True)
-    return entries
+        items.pop(index)
+    return items
 
 
-def _choose_examples(entries, year):
+def _choose_examples(entries, year, num_random=RANDOM_EXAMPLES,
+                     coordinates=None):
     """
     Select items from the list of entries that represent the
     northernmost, southernmost, easternmost, and westernmost,
-    plus the largest, plus a random one.
+    plus a number of random ones.
+
+    The entries are assumed to be already sorted by frequency, highest
+    first (as returned by _winnow()), and to have their coordinates
+    already computed. Alternatively, an array of (latitude, longitude)
+    rows matching the entries can be passed as 'coordinates'.
 
     Returns a set, to prevent duplication.
     """
-    if year <= ANIMATION_START:
+    if year <= ANIMATION_START or not entries:
         return set()
 
-    if entries:
-        # Filter to remove high-frequency stuff
-        filtered = entries[:]
-        filtered.sort(key=lambda e: e.frequency, reverse=True)
-        hifreq = []
-        while len(filtered) > 10 and len(hifreq) < 10:
-            hifreq.append(filtered.pop(0))
-
-        # hifreq = max(entries, key=lambda e: e.frequency)
-        nth = max(filtered, key=lambda e: e.latitude())
-        sth = min(filtered, key=lambda e: e.latitude())
-        west = max(filtered, key=lambda e: e.longitude())
-        east = min(filtered, key=lambda e: e.longitude())
-        rnd1 = random.choice(filtered)  # throw in a random example
-        rnd2 = random.choice(filtered)  # throw in a random example
-        choices = set([(e.id, e.lemma, e.label) for e in
-                       (nth, sth, east, west, rnd1, rnd2)])
-        if len(choices) < 6:
-            extra = random.choice(filtered)
-            choices.add((extra.id, extra.lemma, extra.label))
-        return choices
-    else:
-        return set()
+    if coordinates is None:
+        coordinates = numpy.array([e.coordinates() for e in entries],
+                                  dtype=float)
+
+    # Skip (up to) the ten highest-frequency entries, but always
+    #  leave at least ten to choose from
+    skip = max(0, min(10, len(entries) - 10))
+    filtered = entries[skip:]
+    coordinates = coordinates[skip:]
+
+    # Northernmost, southernmost, 'westernmost' (max. longitude) and
+    #  'easternmost' (min. longitude), in one pass over the array
+    extremes = numpy.concatenate((coordinates.argmax(axis=0),
+                                  coordinates.argmin(axis=0)))
+    chosen = set([int(i) for i in extremes])
+
+    # Throw in some random examples, drawn without replacement from
+    #  the entries not already chosen
+    remainder = [i for i in range(len(filtered)) if i not in chosen]
+    chosen.update(random.sample(remainder, min(num_random, len(remainder))))
+
+    return set([(filtered[i].id, filtered[i].lemma, filtered[i].label)
+                for i in chosen])
+
+
+def _add_words(words, year, entries, language_index):
+    """
+    Add a year's (winnowed) entries to the words.json stream. Years
+    before ANIMATION_START are only listed if they have any entries.
+    """
+    rows = [_word_row(entry, language_index) for entry in entries]
+    if rows or year >= ANIMATION_START:
+        words.add(year, rows)
+
 
+class YearStream(object):
+
+    """
+    Write a JSON object keyed by year to an open file, one year at a
+    time, so that the complete object never has to be held in memory.
+
+    Years must be added in ascending order. Any year between
+    ANIMATION_START and END_YEAR which is not added is written as an
+    empty list, as the D3 app expects every year in that range.
+    """
+
+    def __init__(self, filehandle):
+        self.filehandle = filehandle
+        self.last_year = None
+        self.filehandle.write('{')
+
+    def add(self, year, values):
+        self._pad(year)
+        if self.last_year is not None:
+            self.filehandle.write(', ')
+        self.filehandle.write('%s: %s' % (json.dumps(str(year)),
+                                          json.dumps(values)))
+        self.last_year = year
+
+    def close(self):
+        self._pad(END_YEAR + 1)
+        self.filehandle.write('}')
+
+    def _pad(self, year):
+        if self.last_year is None:
+            start = ANIMATION_START
+        else:
+            start = max(self.last_year + 1, ANIMATION_START)
+        for missing_year in range(start, min(year, END_YEAR + 1)):
+            self.add(missing_year, [])
+
+
+class ExamplesWriter(object):
+
+    """
+    Stream example words to the JSON examples file and the XML examples
+    log at the same time, year by year, as they are selected.
+
+    Use as a context manager; both files are completed on exit.
+    """
 
-def _write_words_file(entries, out_file):
-    for year in range(ANIMATION_START, END_YEAR + 1):
-        if year not in entries:
-            entries[year] = []
-    with open(out_file, 'w') as filehandle:
-        json.dump(entries, filehandle)
-
-
-def _write_examples_file(examples, out_file, log_file):
-    for year in range(ANIMATION_START, END_YEAR + 1):
-        if year not in examples:
-            examples[year] = []
-
-    doc = etree.Element('entries')
-    for year in range(ANIMATION_START, END_YEAR + 1):
-        for entry in examples[year]:
-            k = etree.SubElement(doc, 'entry')
-            k.set('id', entry[0])
-            k.set('hw', entry[2])
-    with open(log_file, 'w') as filehandle:
-        filehandle.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        filehandle.write(etree.tounicode(doc, pretty_print=True))
-
-    examples2 = {}
-    for year, entries in examples.items():
-        entries2 = [(e[0], e[1]) for e in entries]
-        examples2[year] = entries2
-    with open(out_file, 'w') as filehandle:
-        json.dump(examples2, filehandle)
-
-
-def _remove_vulgar(entries):
-    swears = ('shit', 'fuck', 'bugger', 'cunt', 'piss',)
-    entries2 = []
-    for e in entries:
-        if not any([swear in e.lemma for swear in swears]):
-            entries2.append(e)
-    return entries2
+    def __init__(self, out_file, log_file):
+        self.out_file = out_file
+        self.log_file = log_file
+        self._stack = None
+        self._stream = None
+        self._log = None
+        self._logged = 0
+
+    def __enter__(self):
+        self._stack = contextlib.ExitStack()
+        filehandle = self._stack.enter_context(open(self.out_file, 'w'))
+        self._stream = YearStream(filehandle)
+        # The log is written out by hand, element by element, so that it
+        #  comes out the same as the pretty-printed document it replaces
+        self._log = self._stack.enter_context(open(self.log_file, 'w'))
+        self._log.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self._logged = 0
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._stream.close()
+            if self._logged:
+                self._log.write('</entries>\n')
+            else:
+                self._log.write('<entries/>\n')
+        return self._stack.__exit__(exc_type, exc_value, traceback)
+
+    def add(self, year, examples):
+        """
+        Add the examples (tuples of id, lemma, label) for a given year.
+        """
+        examples = list(examples)
+        if year >= ANIMATION_START:
+            for entry in examples:
+                if not self._logged:
+                    self._log.write('<entries>\n')
+                element = etree.Element('entry', id=entry[0], hw=entry[2])
+                self._log.write('  %s\n' % etree.tounicode(element))
+                self._logged += 1
+        self._stream.add(year, [(e[0], e[1]) for e in examples])
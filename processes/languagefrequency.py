@@ -5,12 +5,15 @@ LanguageFrequency
 """
 
 import os
+import itertools
 from collections import defaultdict
 import csv
 
 from lex.oed.resources.frequencyiterator import FrequencyIterator
 from lex.oed.resources.vitalstatistics import VitalStatisticsCache
 import twominuteconfig
+from lib.prefetch import PrefetchIterator
+from lib.checkpoint import Checkpoint
 
 YEARS = list(range(1750, 2010, 10))
 
@@ -31,9 +34,24 @@ class LanguageFrequency(object):
             return {y: 0 for y in YEARS}
         languages = defaultdict(nullvalues)
         num_entries = defaultdict(nullvalues)
+
+        # Pick up from the last checkpoint, if there is one
+        checkpoint = Checkpoint('analyse_language_frequency',
+                                key=os.path.abspath(self.out_dir),
+                                sources=(twominuteconfig.OED_FREQUENCY_DATA,
+                                         twominuteconfig.OED_VITALSTATS_DATA))
+        position, state = checkpoint.load()
+        if state is not None:
+            print('Resuming from checkpoint (entry %d)...' % position)
+            languages.update(state['languages'])
+            num_entries.update(state['num_entries'])
+
         vitalstats = VitalStatisticsCache()
         iterator = FrequencyIterator(message='Measuring language frequency')
-        for entry in iterator.iterate():
+        prefetcher = PrefetchIterator(
+            itertools.islice(iterator.iterate(), position, None))
+        for entry in prefetcher.iterate():
+            position += 1
             if (entry.has_frequency_table() and
                 not ' ' in entry.lemma and
                 not '-' in entry.lemma):
@@ -46,6 +64,10 @@ class LanguageFrequency(object):
                         languages[language][year] += frequency
                         if entry.start < year:
                             num_entries[language][year] += 1
+            if checkpoint.due(position):
+                checkpoint.save(position, {'languages': dict(languages),
+                                           'num_entries': dict(num_entries)})
+        print(prefetcher.report())
 
         rows1 = []
         rows1.append(['language', ] + YEARS)
@@ -66,6 +88,7 @@ class LanguageFrequency(object):
         with (open(self.csv2, 'w')) as csvfile:
             writer = csv.writer(csvfile)
             writer.writerows(rows2)
+        checkpoint.clear()
 
     def load_values(self):
         def load_file(file, function):
@@ -0,0 +1,209 @@
+"""
+ParameterSweep -- Evaluate a grid of dithering/winnowing parameters
+without rerunning the full JSON preparation for each candidate
+
+@author: James McCracken
+"""
+
+import os
+import random
+import itertools
+import multiprocessing
+import json
+import numpy
+
+import twominuteconfig
+from processes.entrylister import EntryCache
+from processes.jsonpreparation import (_thin_out, _choose_examples,
+                                       _add_words, YearStream, ExamplesWriter,
+                                       ENGLISH_LANGUAGES)
+
+ANIMATION_START = twominuteconfig.ANIMATION_START
+START_YEAR = twominuteconfig.START_YEAR
+END_YEAR = twominuteconfig.END_YEAR
+
+# Data shared with the worker processes. This is populated before the
+#  pool is created, so that forked workers inherit it copy-on-write
+#  rather than having it pickled and sent to each of them. Workers
+#  winnow using the numpy columns, and only touch the Entry objects
+#  (whose reference counts would otherwise dirty every shared page)
+#  for the entries which survive winnowing.
+_SHARED = {}
+
+
+class ParameterSweep(object):
+
+    """
+    Load the entry data once, then evaluate each parameter set in the
+    sweep grid in parallel worker processes. Each candidate gets its own
+    words.json and examples.json, and summary metrics for all candidates
+    are written to summary.json.
+    """
+
+    def __init__(self, **kwargs):
+        self.out_dir = kwargs.get('out_dir') or twominuteconfig.SWEEP_DIR
+        self.grid = kwargs.get('grid') or twominuteconfig.SWEEP_GRID
+        self.processes = kwargs.get('processes',
+                                    twominuteconfig.SWEEP_PROCESSES)
+        self.entry_cache = None
+
+    def load_data(self, **kwargs):
+        self.entry_cache = EntryCache(**kwargs)
+        self.entry_cache.load_data()
+
+        print('Computing coordinates and distances...')
+        entries = self.entry_cache.entries
+        coordinates = [e.coordinates() or (numpy.nan, numpy.nan)
+                       for e in entries]
+        distances = numpy.array([e.centre_distance()
+                                 if e.coordinates() is not None
+                                 else numpy.nan for e in entries],
+                                dtype=float)
+        languages = sorted(set([e.language for e in entries]))
+
+        _SHARED['entries'] = entries
+        _SHARED['years'] = numpy.array([e.year for e in entries], dtype=int)
+        _SHARED['latitude'] = numpy.array([c[0] for c in coordinates],
+                                          dtype=float)
+        _SHARED['longitude'] = numpy.array([c[1] for c in coordinates],
+                                           dtype=float)
+        _SHARED['centre_distance'] = distances
+        _SHARED['frequency'] = numpy.array([e.frequency for e in entries],
+                                           dtype=float)
+        # Entries which winnowing may keep (see jsonpreparation._winnow())
+        eligible = numpy.array([e.language not in ENGLISH_LANGUAGES and
+                                not e.suppressed for e in entries],
+                               dtype=bool)
+        _SHARED['eligible'] = eligible & ~numpy.isnan(distances)
+        _SHARED['language_index'] = {l: i for i, l in enumerate(languages)}
+        _SHARED['out_dir'] = self.out_dir
+
+    def candidates(self):
+        """
+        Return a list of parameter sets, one for each combination of
+        values in the sweep grid.
+        """
+        keys = sorted(self.grid.keys())
+        return [dict(zip(keys, values)) for values in
+                itertools.product(*[self.grid[k] for k in keys])]
+
+    def run(self):
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        index_file = os.path.join(self.out_dir, 'language_index.json')
+        with open(index_file, 'w') as filehandle:
+            json.dump(_SHARED['language_index'], filehandle)
+
+        candidates = list(enumerate(self.candidates()))
+        print('Evaluating %d candidates...' % len(candidates))
+        context = multiprocessing.get_context('fork')
+        pool = context.Pool(processes=self.processes)
+        try:
+            summary = pool.map(_evaluate, candidates)
+        finally:
+            pool.close()
+            pool.join()
+
+        summary_file = os.path.join(self.out_dir, 'summary.json')
+        with open(summary_file, 'w') as filehandle:
+            json.dump(summary, filehandle, indent=2)
+        return summary
+
+
+def _evaluate(candidate):
+    """
+    Run dithering, winnowing and example selection for a single
+    parameter set, write its output files, and return its metrics.
+    """
+    index, params = candidate
+    dithers = params.get('dithers', twominuteconfig.DITHERS)
+    winnow_limit = params.get('winnow_limit', twominuteconfig.WINNOW_LIMIT)
+    num_random = params.get('random_examples',
+                            twominuteconfig.RANDOM_EXAMPLES)
+
+    # Seed per candidate, so that each candidate is reproducible
+    random.seed(index)
+    rng = numpy.random.RandomState(index)
+
+    entries = _SHARED['entries']
+    language_index = _SHARED['language_index']
+    dithered = _dither_years(_SHARED['years'], dithers, rng)
+
+    name = 'candidate_%03d' % index
+    out_dir = os.path.join(_SHARED['out_dir'], name)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    word_counts = {}
+    example_ids = []
+    order = numpy.argsort(dithered, kind='mergesort')
+    years, starts = numpy.unique(dithered[order], return_index=True)
+    examples_file = os.path.join(out_dir, 'examples.json')
+    log_file = os.path.join(out_dir, 'example_words.xml')
+    with open(os.path.join(out_dir, 'words.json'), 'w') as filehandle, \
+            ExamplesWriter(examples_file, log_file) as writer:
+        words = YearStream(filehandle)
+        for year, indexes in zip(years, numpy.split(order, starts[1:])):
+            year = int(year)
+            if START_YEAR <= year <= END_YEAR:
+                indexes = _winnow_indexes(indexes, winnow_limit)
+                entry_list = [entries[i] for i in indexes]
+                coordinates = numpy.column_stack(
+                    (_SHARED['latitude'][indexes],
+                     _SHARED['longitude'][indexes]))
+                examples = _choose_examples(entry_list, year,
+                                            num_random=num_random,
+                                            coordinates=coordinates)
+                writer.add(year, examples)
+                example_ids.extend([e[0] for e in examples])
+                _add_words(words, year, entry_list, language_index)
+                word_counts[year] = len(entry_list)
+        words.close()
+
+    counts = [word_counts.get(y, 0) for y in
+              range(ANIMATION_START, END_YEAR + 1)]
+    metrics = {
+        'words': sum(counts),
+        'mean_words_per_year': float(numpy.mean(counts)),
+        'max_words_per_year': max(counts),
+        'empty_years': counts.count(0),
+        'examples': len(example_ids),
+        'distinct_examples': len(set(example_ids)),
+    }
+
+    return {'candidate': name,
+            'params': {'dithers': [list(d) for d in dithers],
+                       'winnow_limit': winnow_limit,
+                       'random_examples': num_random},
+            'metrics': metrics}
+
+
+def _winnow_indexes(indexes, limit):
+    """
+    Equivalent of jsonpreparation._winnow(), working on an array of
+    indexes into the shared columns rather than on Entry objects.
+    Returns an array of the indexes kept, highest frequency first.
+    """
+    indexes = indexes[_SHARED['eligible'][indexes]]
+    order = numpy.argsort(_SHARED['centre_distance'][indexes],
+                          kind='mergesort')
+    indexes = numpy.array(_thin_out(indexes[order], limit), dtype=int)
+    order = numpy.argsort(-_SHARED['frequency'][indexes], kind='mergesort')
+    return indexes[order]
+
+
+def _dither_years(years, dithers, rng):
+    """
+    Vectorized equivalent of Entry.dithered_year(), using an arbitrary
+    set of dithers. Returns an array of dithered years.
+    """
+    in_range = (years >= 500) & (years <= END_YEAR)
+    ranges = numpy.interp(years, [d[0] for d in dithers],
+                          [d[1] for d in dithers]).astype(int)
+    ranges[~in_range] = 0
+    offsets = rng.randint(0, ranges + 1)
+    dithered = numpy.where(ranges < 1, years,
+                           (years - (ranges / 2) + offsets).astype(int))
+    outliers = numpy.count_nonzero(~in_range)
+    dithered[~in_range] = rng.randint(600, 701, size=outliers)
+    return dithered
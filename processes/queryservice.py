@@ -0,0 +1,274 @@
+"""
+QueryService -- Long-lived HTTP query server over the entry data
+
+@author: James McCracken
+"""
+
+import json
+import functools
+from urllib.parse import urlparse, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy
+
+import twominuteconfig
+from processes.entrylister import EntryCache
+
+EARTH_RADIUS_MILES = 3960
+
+
+class EntryIndex(object):
+
+    """
+    Columnar index of the entries in EntryCache (one numpy array per
+    field), answering filter/aggregate queries without reloading or
+    re-dithering the source data.
+
+    Queries are dicts of string parameters (as parsed from a URL query
+    string), e.g. {'op': 'top', 'language': 'Latin', 'start': '1600',
+    'end': '1650'}. Results of recent queries are held in a bounded
+    LRU cache.
+    """
+
+    def __init__(self, **kwargs):
+        self.cache_size = kwargs.pop('cache_size',
+                                     twominuteconfig.QUERY_CACHE_SIZE)
+        self.entry_cache = EntryCache(**kwargs)
+        self._cached_query = functools.lru_cache(
+            maxsize=self.cache_size)(self._run_query)
+
+    def load_data(self):
+        self.entry_cache.dither()
+        entries = self.entry_cache.entries
+
+        self.languages = sorted(set([e.language for e in entries]))
+        self.groups = sorted(set([str(e.language_group()) for e in entries]))
+        language_codes = {l: i for i, l in enumerate(self.languages)}
+        group_codes = {g: i for i, g in enumerate(self.groups)}
+        coordinates = [e.coordinates() or (numpy.nan, numpy.nan)
+                       for e in entries]
+
+        self.ids = [e.id for e in entries]
+        self.lemmas = [e.lemma for e in entries]
+        self.year = numpy.array([e.year for e in entries], dtype=int)
+        self.dithered_year = numpy.array([e.dithered_year() for e in entries],
+                                         dtype=int)
+        self.frequency = numpy.array([e.frequency for e in entries])
+        self.band = numpy.array([e.band for e in entries], dtype=int)
+        self.language = numpy.array([language_codes[e.language]
+                                     for e in entries], dtype=int)
+        self.group = numpy.array([group_codes[str(e.language_group())]
+                                  for e in entries], dtype=int)
+        self.latitude = numpy.array([c[0] for c in coordinates], dtype=float)
+        self.longitude = numpy.array([c[1] for c in coordinates], dtype=float)
+        self._cached_query.cache_clear()
+
+    def query(self, params):
+        """
+        Run a query, returning a JSON-serializable result. Raises
+        ValueError if the query is malformed.
+        """
+        key = tuple(sorted(params.items()))
+        return self._cached_query(key)
+
+    def _run_query(self, key):
+        params = dict(key)
+        operation = params.get('op', 'top')
+        if operation == 'top':
+            return self._top(params)
+        elif operation == 'aggregate':
+            return self._aggregate(params)
+        elif operation == 'cumulative':
+            return self._cumulative(params)
+        elif operation == 'near':
+            return self._near(params)
+        else:
+            raise ValueError('Unknown operation "%s"' % operation)
+
+    def _mask(self, params):
+        """
+        Return a boolean array selecting the entries which match the
+        filter parameters: start/end (inclusive years; dithered years if
+        'dithered' is set), language and group (comma-separated lists),
+        and band.
+        """
+        if _flag(params, 'dithered'):
+            years = self.dithered_year
+        else:
+            years = self.year
+        mask = numpy.ones(len(self.ids), dtype=bool)
+        if 'start' in params:
+            mask &= years >= int(params['start'])
+        if 'end' in params:
+            mask &= years <= int(params['end'])
+        if 'language' in params:
+            codes = [self.languages.index(l) for l in
+                     params['language'].split(',') if l in self.languages]
+            mask &= numpy.isin(self.language, codes)
+        if 'group' in params:
+            codes = [self.groups.index(g) for g in
+                     params['group'].split(',') if g in self.groups]
+            mask &= numpy.isin(self.group, codes)
+        if 'band' in params:
+            mask &= self.band == int(params['band'])
+        return mask
+
+    def _rows(self, indexes, **extra):
+        rows = []
+        for i in indexes:
+            row = {'id': self.ids[i],
+                   'lemma': self.lemmas[i],
+                   'year': int(self.year[i]),
+                   'dithered_year': int(self.dithered_year[i]),
+                   'frequency': float(self.frequency[i]),
+                   'band': int(self.band[i]),
+                   'language': self.languages[self.language[i]],
+                   'group': self.groups[self.group[i]]}
+            for field, values in extra.items():
+                row[field] = float(values[i])
+            rows.append(row)
+        return rows
+
+    def _top(self, params):
+        """
+        Highest-frequency entries matching the filter ('n', default 20).
+        """
+        size = _size(params)
+        indexes = numpy.flatnonzero(self._mask(params))
+        if len(indexes) > size:
+            partition = numpy.argpartition(-self.frequency[indexes], size)
+            indexes = indexes[partition[:size]]
+        indexes = indexes[numpy.argsort(-self.frequency[indexes],
+                                        kind='mergesort')]
+        return self._rows(indexes)
+
+    def _aggregate(self, params):
+        """
+        Entry count and summed frequency of entries matching the filter,
+        grouped by 'by' (language, group, band, year, or decade).
+        """
+        mask = self._mask(params)
+        field = params.get('by', 'group')
+        if field == 'language':
+            values, labels = self.language[mask], self.languages
+        elif field == 'group':
+            values, labels = self.group[mask], self.groups
+        elif field in ('band', 'year', 'decade'):
+            if field == 'band':
+                column = self.band
+            elif _flag(params, 'dithered'):
+                column = self.dithered_year
+            else:
+                column = self.year
+            if field == 'decade':
+                column = (column // 10) * 10
+            labels, values = numpy.unique(column[mask], return_inverse=True)
+            labels = [int(l) for l in labels]
+        else:
+            raise ValueError('Cannot aggregate by "%s"' % field)
+
+        counts = numpy.bincount(values, minlength=len(labels))
+        sums = numpy.bincount(values, weights=self.frequency[mask],
+                              minlength=len(labels))
+        return {str(label): {'count': int(count), 'frequency': float(total)}
+                for label, count, total in zip(labels, counts, sums)
+                if count}
+
+    def _cumulative(self, params):
+        """
+        Summed frequency, by language group, of all entries matching
+        the filter whose (dithered) year is no later than 'year'.
+        """
+        year = int(params['year'])
+        mask = self._mask(params) & (self.dithered_year <= year)
+        sums = numpy.bincount(self.group[mask], weights=self.frequency[mask],
+                              minlength=len(self.groups))
+        return {group: float(total) for group, total in zip(self.groups, sums)}
+
+    def _near(self, params):
+        """
+        Entries matching the filter that are nearest to the point given
+        by 'lat' and 'lon' ('n', default 20). Distances are in miles.
+        """
+        size = _size(params)
+        latitude = numpy.radians(float(params['lat']))
+        longitude = numpy.radians(float(params['lon']))
+        mask = self._mask(params) & ~numpy.isnan(self.latitude)
+        indexes = numpy.flatnonzero(mask)
+
+        lats = numpy.radians(self.latitude[indexes])
+        lons = numpy.radians(self.longitude[indexes])
+        a = (numpy.sin((lats - latitude) / 2) ** 2 +
+             numpy.cos(lats) * numpy.cos(latitude) *
+             numpy.sin((lons - longitude) / 2) ** 2)
+        distances = numpy.zeros(len(self.ids))
+        distances[indexes] = (2 * EARTH_RADIUS_MILES *
+                              numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a)))
+
+        order = numpy.argsort(distances[indexes], kind='mergesort')
+        return self._rows(indexes[order[:size]], distance=distances)
+
+
+def _flag(params, name):
+    """
+    Parse a boolean query parameter ('1'/'true'/'yes' or '0'/'false'/'no').
+    """
+    value = params.get(name, '').strip().lower()
+    if value in ('', '0', 'false', 'no', 'off'):
+        return False
+    elif value in ('1', 'true', 'yes', 'on'):
+        return True
+    else:
+        raise ValueError('Invalid value for "%s": "%s"' % (name, value))
+
+
+def _size(params):
+    """
+    Parse the 'n' (number of results) query parameter; default 20.
+    """
+    size = int(params.get('n', 20))
+    if size < 0:
+        raise ValueError('"n" must not be negative')
+    return size
+
+
+class QueryServer(ThreadingHTTPServer):
+
+    """
+    HTTP server answering GET requests of the form
+    /<op>?<param>=<value>&... with JSON, using an EntryIndex.
+    """
+
+    def __init__(self, index, address=None):
+        self.index = index
+        ThreadingHTTPServer.__init__(
+            self, address or twominuteconfig.QUERY_SERVER_ADDRESS,
+            _QueryHandler)
+
+
+class _QueryHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        if url.path.strip('/'):
+            params['op'] = url.path.strip('/')
+        try:
+            result = self.server.index.query(params)
+        except (ValueError, KeyError) as error:
+            self._respond(400, {'error': str(error)})
+        except Exception as error:
+            self._respond(500, {'error': '%s: %s' % (type(error).__name__,
+                                                     error)})
+        else:
+            self._respond(200, result)
+
+    def _respond(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -12,6 +12,8 @@ PIPELINE = (
     ('analyse_language_frequency', 0),
     ('list_entries', 0),
     ('prepare_json_files', 1),
+    ('sweep_parameters', 0),
+    ('serve_queries', 0),
 )
 
 BASE_DIR = os.path.join(lexconfig.OED_DIR, 'projects/twominuteoed')
@@ -20,6 +22,33 @@ LANGUAGE_COORDINATES = os.path.join(BASE_DIR, 'language_coordinates.csv')
 LANGUAGE_FREQUENCY_DIR = os.path.join(BASE_DIR, 'language_frequency')
 EXAMPLE_WORDS_LOG = os.path.join(BASE_DIR, 'two_minute_oed_example_words.xml')
 DATAVIS_DIR = os.path.join(BASE_DIR, 'twominuteoed/data')
+BLOCKLIST = os.path.join(BASE_DIR, 'blocklist.txt')
+SWEEP_DIR = os.path.join(BASE_DIR, 'sweep')
+CHECKPOINT_DIR = os.path.join(BASE_DIR, 'checkpoints')
+LOG_DIR = os.path.join(BASE_DIR, 'logs')
+TOP_INDEX = os.path.join(BASE_DIR, 'top_index.json')
+
+# Locations of the OED data read by the scan stages, taken from lex's
+#  own configuration: frequency tables, vital statistics, and entry
+#  text (read for language overrides). If lex does not define one of
+#  these, changes to that data cannot be detected, so the scan stages
+#  will not resume from a checkpoint or list entries incrementally.
+OED_FREQUENCY_DATA = getattr(lexconfig, 'FREQUENCY_DIR', None)
+OED_VITALSTATS_DATA = getattr(lexconfig, 'VITALSTATISTICS_DIR', None)
+OED_TEXT_DATA = getattr(lexconfig, 'OEDLATEST_TEXT_DIR', None)
+
+# Files/directories read (first tuple) and written (second tuple) by
+#  each pipeline stage. A stage waits for any earlier enabled stage
+#  that writes one of its inputs; otherwise stages may run concurrently.
+STAGE_ARTIFACTS = {
+    'analyse_language_frequency': ((), (LANGUAGE_FREQUENCY_DIR,)),
+    'list_entries': ((LANGUAGE_COORDINATES,), (SOURCE_DATA,)),
+    'prepare_json_files': ((SOURCE_DATA, LANGUAGE_COORDINATES, BLOCKLIST),
+                           (DATAVIS_DIR, EXAMPLE_WORDS_LOG, TOP_INDEX)),
+    'sweep_parameters': ((SOURCE_DATA, LANGUAGE_COORDINATES, BLOCKLIST),
+                         (SWEEP_DIR,)),
+    'serve_queries': ((SOURCE_DATA, LANGUAGE_COORDINATES, BLOCKLIST), ()),
+}
 
 START_YEAR = 800
 END_YEAR = 2010
@@ -56,3 +85,53 @@ NONEUROPEAN_LANGUAGES = ('Middle Eastern and Afro-Asiatic languages',
 DITHERS = list(reversed([(2010, 0), (1800, 2), (1700, 5), (1500, 10),
                          (1400, 20), (1200, 50), (1100, 70),
                          (950, 100), (500, 150)]))
+
+# Maximum number of entries kept for each year (see
+#  jsonpreparation._winnow()), and number of random example words
+#  picked for each year (in addition to the geographical extremes).
+WINNOW_LIMIT = 50
+RANDOM_EXAMPLES = 2
+
+# Grid of parameter sets evaluated by the parameter sweep: every
+#  combination of the values listed here is tried. Each candidate
+#  is written to its own subdirectory of SWEEP_DIR.
+SWEEP_GRID = {
+    'dithers': [DITHERS, ],
+    'winnow_limit': [30, 50, 80],
+    'random_examples': [2, 4],
+}
+# Number of worker processes used by the sweep (None = one per CPU)
+SWEEP_PROCESSES = None
+
+# Address for the query server, and number of recent query results
+#  that it caches
+QUERY_SERVER_ADDRESS = ('127.0.0.1', 8765)
+QUERY_CACHE_SIZE = 256
+
+# Background prefetching of OED entries (see lib/prefetch.py): maximum
+#  number of batches queued, and number of entries per batch
+PREFETCH_DEPTH = 8
+PREFETCH_BATCH_SIZE = 200
+
+# Number of entries between checkpoints when scanning the OED (see
+#  lib/checkpoint.py)
+CHECKPOINT_INTERVAL = 20000
+
+# If True, list_entries only reprocesses entries which have changed
+#  since the last run (based on the fingerprints stored alongside
+#  SOURCE_DATA), and merges them into the existing file. It falls back
+#  to listing all entries if the language coordinates, vital statistics
+#  or entry text have changed (see processes/entrylister.py)
+INCREMENTAL_LISTING = False
+
+# Size (in degrees) of the grid cells used for the density tiles
+#  written by jsonpreparation (density.json)
+DENSITY_CELL_SIZE = 5
+
+# Number of highest-frequency entries kept for each year, decade and
+#  language group in the top-k index (TOP_INDEX)
+TOP_K = 20
+
+# Interval (in years) between keyframes in the animation frames file
+#  written by jsonpreparation (frames.json)
+FRAME_KEYFRAME_INTERVAL = 50